@@ -3,6 +3,9 @@
 CloudLab Profile for NVIDIA GH200 (nvidiagh) + H100
 Python 2 compatible, no Tour section.
 """
+import base64
+import re
+
 import geni.portal as portal
 import geni.rspec.pg as PG
 
@@ -17,18 +20,122 @@ pc.defineParameter("image_urn", "Disk image URN",
                    portal.ParameterType.STRING,
                    "urn:publicid:IDN+utah.cloudlab.us+image+Canonical:ubuntu-22.04",
                    longDescription="Keep default unless you have a custom image")
+pc.defineParameter("prebaked", "Image has Docker + NVIDIA toolkit baked in",
+                   portal.ParameterType.BOOLEAN, False,
+                   longDescription="Set when image_urn points at your own snapshot: boot one node "
+                                   "with this off, wait for setup to finish, run "
+                                   "'sudo /usr/local/etc/emulab/prepare' and take a disk image. "
+                                   "Boot then only configures and verifies")
+pc.defineParameter("best_effort_lan", "Best-effort multi-node LAN",
+                   portal.ParameterType.BOOLEAN, False,
+                   longDescription="Skip bandwidth guarantees on the experiment LAN; "
+                                   "it maps faster but links may be shared")
+pc.defineParameter("lan_bandwidth", "LAN bandwidth (Gbps)",
+                   portal.ParameterType.INTEGER, 100,
+                   longDescription="Per-link bandwidth requested for the multi-node LAN; "
+                                   "0 leaves it to the mapper")
+pc.defineParameter("extras", "Extra apt packages",
+                   portal.ParameterType.STRING, "",
+                   longDescription="Space- or comma-separated packages to add to the base set, "
+                                   "e.g. build-essential htop")
+pc.defineParameter("wheel_dataset_urn", "Wheel cache dataset URN",
+                   portal.ParameterType.STRING, "",
+                   longDescription="Optional image-backed dataset of pip wheels, mounted at "
+                                   "/opt/wheels and used as pip find-links")
 params = pc.bindParameters()
 
+EXTRA_PKGS = params.extras.replace(",", " ").split()
+if not all(re.match(r"^[a-z0-9][a-z0-9.+-]*$", p) for p in EXTRA_PKGS):
+    pc.reportError(portal.ParameterError("Invalid package name in extras", ["extras"]))
+if params.wheel_dataset_urn and not params.wheel_dataset_urn.startswith("urn:publicid:IDN+"):
+    pc.reportError(portal.ParameterError("Dataset must be a URN", ["wheel_dataset_urn"]))
+if int(params.lan_bandwidth) < 0:
+    pc.reportError(portal.ParameterError("LAN bandwidth must be 0 or positive", ["lan_bandwidth"]))
+pc.verifyParameters()
+
+# Experiment LAN addressing (multi-node only)
+LAN_PREFIX = "10.10.1"
+LAN_SUBNET = LAN_PREFIX + ".0/24"
+CACHE_HOST = LAN_PREFIX + ".1"  # node1's LAN address
+
+WHEELS_DIR = "/opt/wheels"
+
+# ---------------- Shared script tail ----------------
+# Appended to both SETUP_BASH and PREBAKED_BASH.
+COMMON_TAIL = r"""
+# Persistence mode: make sure the daemon is up and it took effect, otherwise
+# fall back to nvidia-smi -pm 1
+if command -v nvidia-smi >/dev/null 2>&1; then
+  sudo systemctl start nvidia-persistenced || true
+  PM=$(nvidia-smi --query-gpu=persistence_mode --format=csv,noheader 2>/dev/null || true)
+  if [ -z "$PM" ] || echo "$PM" | grep -qv Enabled; then
+    echo "[WARN] nvidia-persistenced did not enable persistence mode; using nvidia-smi -pm 1"
+    sudo nvidia-smi -pm 1 || true
+  fi
+fi
+
+# NCCL: pin socket traffic to the experiment LAN instead of the control NIC
+if [ -n "${LAN_SUBNET:-}" ]; then
+  LAN_IF=$(ip -o -4 addr show to "$LAN_SUBNET" | awk '{print $2; exit}')
+  # Only the HCA behind the LAN interface (or its parent, for a VLAN iface)
+  LAN_DEV=$LAN_IF
+  if [ -n "$LAN_DEV" ] && [ ! -e "/sys/class/net/$LAN_DEV/device" ]; then
+    LOWER=$(ls -d /sys/class/net/$LAN_DEV/lower_* 2>/dev/null | head -n1 || true)
+    [ -n "$LOWER" ] && LAN_DEV=${LOWER##*/lower_}
+  fi
+  IB_HCA=""
+  if [ -n "$LAN_DEV" ]; then
+    IB_HCA=$(ls /sys/class/net/$LAN_DEV/device/infiniband 2>/dev/null | paste -sd, - || true)
+  fi
+  {
+    [ -n "$LAN_IF" ] && echo "export NCCL_SOCKET_IFNAME=$LAN_IF"
+    [ -n "$IB_HCA" ] && echo "export NCCL_IB_HCA=$IB_HCA"
+    true
+  } | sudo tee /etc/profile.d/nccl-net.sh >/dev/null
+fi
+
+# Point pip at the wheel cache dataset, if one is mounted
+if [ -n "${WHEELS_DIR:-}" ] && [ -d "$WHEELS_DIR" ]; then
+  printf '[global]\nfind-links = file://%s\n' "$WHEELS_DIR" | sudo tee /etc/pip.conf >/dev/null
+fi
+
+echo '[INFO] Local NVMe:'
+lsblk -o NAME,SIZE,MODEL || true
+
+echo "[DONE] Setup complete."
+"""
+
 # ---------------- Per-node setup script ----------------
 SETUP_BASH = r"""#!/usr/bin/env bash
 set -eux
 
 echo "[INFO] Node: $(hostname)  Arch: $(uname -m)  Kernel: $(uname -r)"
 
-# Base pkgs
-sudo apt-get update -y
-sudo apt-get install -y git curl wget ca-certificates gnupg lsb-release \
-  pciutils net-tools htop jq build-essential apt-transport-https software-properties-common
+# Cluster cache: node1 (server) runs apt-cacher-ng + a Docker Hub pull-through
+# registry bound to its LAN address (CACHE_HOST) only, so neither is exposed on
+# the public control NIC; peers (client) use them over the experiment LAN.
+CACHE_ROLE=${CACHE_ROLE:-none}
+CACHE_HOST=${CACHE_HOST:-}
+EXTRA_PKGS=${EXTRA_PKGS:-}
+WHEELS_DIR=${WHEELS_DIR:-}
+APT_GET="sudo DEBIAN_FRONTEND=noninteractive apt-get -y -o Dpkg::Use-Pty=0"
+
+# Repo setup needs curl + gpg; stock images ship them, so this rarely runs
+if ! command -v curl >/dev/null 2>&1 || ! command -v gpg >/dev/null 2>&1; then
+  $APT_GET update
+  $APT_GET install --no-install-recommends curl ca-certificates gnupg
+fi
+if [ "$CACHE_ROLE" = server ]; then
+  if ! dpkg -s apt-cacher-ng >/dev/null 2>&1; then
+    $APT_GET update
+    $APT_GET install --no-install-recommends apt-cacher-ng
+  fi
+  if ! grep -q "^BindAddress: $CACHE_HOST\$" /etc/apt-cacher-ng/acng.conf; then
+    sudo sed -i '/^BindAddress:/d' /etc/apt-cacher-ng/acng.conf
+    echo "BindAddress: $CACHE_HOST" | sudo tee -a /etc/apt-cacher-ng/acng.conf >/dev/null
+    sudo systemctl restart apt-cacher-ng
+  fi
+fi
 
 # Check driver
 if command -v nvidia-smi >/dev/null 2>&1; then
@@ -37,68 +144,248 @@ else
   echo "[WARN] nvidia-smi not found. Use a GPU-enabled image or install a driver."
 fi
 
-# Docker
+# Sysctl does not depend on apt; run it alongside the repo setup below
+(
+printf 'fs.inotify.max_user_watches=524288\nfs.inotify.max_user_instances=1024\nvm.max_map_count=1048576\n' | \
+  sudo tee /etc/sysctl.d/99-dl-tuning.conf >/dev/null
+sudo sysctl -p /etc/sysctl.d/99-dl-tuning.conf || true
+) &
+SYSCTL_PID=$!
+
+# Docker and NVIDIA repo keys/lists are independent network fetches: run them concurrently
+NEED_DOCKER=0
 if ! command -v docker >/dev/null 2>&1; then
-  sudo apt-get remove -y docker docker-engine docker.io containerd runc || true
-  curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --dearmor -o /usr/share/keyrings/docker.gpg
-  echo "deb [arch=$(dpkg --print-architecture) signed-by=/usr/share/keyrings/docker.gpg] https://download.docker.com/linux/ubuntu $(. /etc/os-release; echo $UBUNTU_CODENAME) stable" | \
-    sudo tee /etc/apt/sources.list.d/docker.list >/dev/null
-  sudo apt-get update -y
-  sudo apt-get install -y docker-ce docker-ce-cli containerd.io
+  NEED_DOCKER=1
+  $APT_GET remove docker docker-engine docker.io containerd runc || true
+  (
+    curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --batch --yes --dearmor -o /usr/share/keyrings/docker.gpg
+    echo "deb [arch=$(dpkg --print-architecture) signed-by=/usr/share/keyrings/docker.gpg] https://download.docker.com/linux/ubuntu $(. /etc/os-release; echo $UBUNTU_CODENAME) stable" | \
+      sudo tee /etc/apt/sources.list.d/docker.list >/dev/null
+  ) &
+  DOCKER_REPO_PID=$!
+fi
+
+NEED_TOOLKIT=0
+if ! dpkg -s nvidia-container-toolkit >/dev/null 2>&1; then
+  NEED_TOOLKIT=1
+  distribution=$(. /etc/os-release; echo $ID$VERSION_ID)
+  (
+    if [ ! -s /usr/share/keyrings/nvidia-container-toolkit.gpg ]; then
+      curl -fsSL https://nvidia.github.io/libnvidia-container/gpgkey | sudo gpg --batch --yes --dearmor -o /usr/share/keyrings/nvidia-container-toolkit.gpg
+    fi
+    if [ ! -s /etc/apt/sources.list.d/nvidia-container-toolkit.list ]; then
+      curl -fsSL https://nvidia.github.io/libnvidia-container/$distribution/libnvidia-container.list | \
+        sed 's#deb https://#deb [signed-by=/usr/share/keyrings/nvidia-container-toolkit.gpg] https://#g' | \
+        sudo tee /etc/apt/sources.list.d/nvidia-container-toolkit.list
+    fi
+  ) &
+  NVIDIA_REPO_PID=$!
+fi
+
+if [ "$NEED_DOCKER" = 1 ]; then
+  wait "$DOCKER_REPO_PID"
+fi
+if [ "$NEED_TOOLKIT" = 1 ]; then
+  wait "$NVIDIA_REPO_PID"
+fi
+
+# Base pkgs + Docker + NVIDIA Container Toolkit in a single apt transaction,
+# skipped entirely when everything is already installed (warm reboot)
+PKGS="git curl wget ca-certificates gnupg lsb-release pciutils net-tools jq ${EXTRA_PKGS//,/ }"
+if dpkg -s $PKGS >/dev/null 2>&1; then
+  PKGS=""
+fi
+if [ "$NEED_TOOLKIT" = 1 ]; then
+  PKGS="$PKGS nvidia-container-toolkit"
+fi
+if [ "$NEED_DOCKER" = 1 ]; then
+  # Recommends of docker-ce/-cli, kept explicitly since we skip recommends:
+  # compose/buildx CLI plugins, and pigz for parallel layer decompression
+  PKGS="$PKGS docker-ce docker-ce-cli containerd.io docker-buildx-plugin docker-compose-plugin pigz"
+fi
+if [ -n "${PKGS// /}" ]; then
+  # Peers go through node1's apt proxy for this run only (no apt.conf.d entry,
+  # so later apt use does not depend on node1 being up). Only the http Ubuntu
+  # archive is cached: apt-cacher-ng rejects CONNECT, so the https Docker and
+  # NVIDIA repos must go DIRECT and are still fetched from the WAN per node.
+  APT_PROXY=""
+  if [ "$CACHE_ROLE" = client ]; then
+    for _ in $(seq 30); do
+      if timeout 2 bash -c "</dev/tcp/$CACHE_HOST/3142" 2>/dev/null; then
+        APT_PROXY="-o Acquire::http::Proxy=http://$CACHE_HOST:3142 -o Acquire::https::Proxy=DIRECT"
+        break
+      fi
+      sleep 5
+    done
+  fi
+  $APT_GET $APT_PROXY update
+  $APT_GET $APT_PROXY install --no-install-recommends $PKGS
+fi
+if [ "$NEED_DOCKER" = 1 ]; then
   sudo usermod -aG docker $USER || true
 fi
 
-# NVIDIA Container Toolkit
-distribution=$(. /etc/os-release; echo $ID$VERSION_ID)
-curl -fsSL https://nvidia.github.io/libnvidia-container/gpgkey | sudo gpg --dearmor -o /usr/share/keyrings/nvidia-container-toolkit.gpg
-curl -fsSL https://nvidia.github.io/libnvidia-container/$distribution/libnvidia-container.list | \
-  sed 's#deb https://#deb [signed-by=/usr/share/keyrings/nvidia-container-toolkit.gpg] https://#g' | \
-  sudo tee /etc/apt/sources.list.d/nvidia-container-toolkit.list
-sudo apt-get update -y
-sudo apt-get install -y nvidia-container-toolkit
-sudo nvidia-ctk runtime configure --runtime=docker || true
-sudo systemctl restart docker || true
+# Docker daemon config: nvidia as the default runtime (no per-container --gpus),
+# CDI for --device requests, and the node1 mirror on peers. These keys are
+# merged into any existing daemon.json (image-provided keys are kept). Runtimes
+# and registry mirrors are live-reloadable; "features" is not, so the daemon is
+# restarted once when CDI is first turned on (needed on Docker < 28).
+MIRRORS=""
+if [ "$CACHE_ROLE" = client ]; then
+  MIRRORS=",\"registry-mirrors\":[\"http://$CACHE_HOST:5000\"]"
+fi
+WANT_JSON="{\"default-runtime\":\"nvidia\",\"runtimes\":{\"nvidia\":{\"path\":\"nvidia-container-runtime\",\"args\":[]}},\"features\":{\"cdi\":true}$MIRRORS}"
+OLD_JSON='{}'
+if [ -s /etc/docker/daemon.json ]; then
+  OLD_JSON=$(jq -c . /etc/docker/daemon.json)
+fi
+NEW_JSON=$(echo "$OLD_JSON" | jq -c --argjson want "$WANT_JSON" '. * $want')
+if [ "$NEW_JSON" != "$OLD_JSON" ]; then
+  echo "$NEW_JSON" | jq . | sudo tee /etc/docker/daemon.json >/dev/null
+  if echo "$OLD_JSON" | jq -e '.features.cdi == true' >/dev/null; then
+    sudo systemctl reload docker || true
+  else
+    sudo systemctl restart docker || true
+  fi
+fi
+
+# Pull the test image in the background; it overlaps the steps below.
+# Peers load it from node1's exported tarball over the LAN, falling back to a
+# regular pull (through the node1 mirror) as soon as node1 reports the export
+# failed (404), or if node1 does not serve it in time.
+CUDA_IMAGE=nvidia/cuda:12.4.1-base-ubuntu22.04
+if [ "$CACHE_ROLE" = client ] && ! sudo docker image inspect "$CUDA_IMAGE" >/dev/null 2>&1; then
+  (
+    set -o pipefail
+    for _ in $(seq 60); do
+      CODE=$(curl -s -o /dev/null -w '%{http_code}' -I "http://$CACHE_HOST:8000/cuda.tar" || true)
+      if [ "$CODE" = 200 ]; then
+        curl -fsS "http://$CACHE_HOST:8000/cuda.tar" | sudo docker load && exit 0
+        break
+      elif [ "$CODE" = 404 ]; then
+        break
+      fi
+      sleep 5
+    done
+    sudo docker pull "$CUDA_IMAGE"
+  ) >/tmp/pull.log 2>&1 &
+else
+  ( sudo docker pull "$CUDA_IMAGE" >/tmp/pull.log 2>&1 ) &
+fi
+PULL_PID=$!
+
+if [ "$CACHE_ROLE" = server ] && ! sudo docker inspect registry-mirror >/dev/null 2>&1; then
+  sudo docker run -d --restart=always --name registry-mirror -p "$CACHE_HOST:5000:5000" \
+    -e REGISTRY_PROXY_REMOTEURL=https://registry-1.docker.io registry:2 || true
+fi
 
-# Persistence + test
+# CDI spec + persistence + test. Ubuntu's nvidia-persistenced unit runs with
+# --no-persistence-mode and StopWhenUnneeded, so override both; the unit is only
+# reloaded/restarted when the drop-in changes (COMMON_TAIL starts and verifies it).
 if command -v nvidia-smi >/dev/null 2>&1; then
-  sudo nvidia-smi -pm 1 || true
-  docker run --rm --gpus all nvidia/cuda:12.4.1-base-ubuntu22.04 nvidia-smi || true
+  sudo nvidia-ctk cdi generate --output=/etc/cdi/nvidia.yaml || true
+  PERSIST_DROPIN=/etc/systemd/system/nvidia-persistenced.service.d/persistence-mode.conf
+  PERSIST_CONF='[Unit]\nStopWhenUnneeded=false\n\n[Service]\nExecStart=\nExecStart=/usr/bin/nvidia-persistenced --user nvidia-persistenced --verbose\n\n[Install]\nWantedBy=multi-user.target\n'
+  if ! printf "$PERSIST_CONF" | cmp -s - "$PERSIST_DROPIN"; then
+    sudo mkdir -p "$(dirname "$PERSIST_DROPIN")"
+    printf "$PERSIST_CONF" | sudo tee "$PERSIST_DROPIN" >/dev/null
+    sudo systemctl daemon-reload
+    sudo systemctl enable nvidia-persistenced || true
+    sudo systemctl restart nvidia-persistenced || true
+  fi
+fi
+wait "$PULL_PID" || true
+# node1 serves /srv/cuda-image only once the export has finished: either
+# cuda.tar is there, or only the export-failed marker is and peers get a 404.
+if [ "$CACHE_ROLE" = server ]; then
+  if [ ! -s /srv/cuda-image/cuda.tar ]; then
+    sudo mkdir -p /srv/cuda-image
+    sudo rm -f /srv/cuda-image/export-failed
+    if sudo docker save -o /srv/cuda-image/cuda.tar.tmp "$CUDA_IMAGE"; then
+      sudo mv /srv/cuda-image/cuda.tar.tmp /srv/cuda-image/cuda.tar
+    else
+      sudo rm -f /srv/cuda-image/cuda.tar.tmp
+      sudo touch /srv/cuda-image/export-failed
+    fi
+  fi
+  if ! timeout 2 bash -c "</dev/tcp/$CACHE_HOST/8000" 2>/dev/null; then
+    sudo setsid nohup python3 -m http.server 8000 --bind "$CACHE_HOST" --directory /srv/cuda-image >/dev/null 2>&1 &
+  fi
+fi
+if command -v nvidia-smi >/dev/null 2>&1; then
+  docker run --rm "$CUDA_IMAGE" nvidia-smi || true
 fi
 
-# Minor sysctl for DL
-sudo bash -c 'cat >/etc/sysctl.d/99-dl-tuning.conf <<EOF
-fs.inotify.max_user_watches=524288
-fs.inotify.max_user_instances=1024
-vm.max_map_count=1048576
-EOF'
-sudo sysctl --system || true
+wait "$SYSCTL_PID" || true
+""" + COMMON_TAIL
 
-echo "[DONE] Setup complete."
-"""
+# ---------------- Prebaked-image setup ----------------
+# Image recipe: instantiate one node with prebaked=False and let SETUP_BASH
+# finish (it pulls the CUDA test image and installs the nvidia-persistenced
+# override, both of which carry into the image), then run
+# `sudo /usr/local/etc/emulab/prepare` and snapshot it from the portal.
+# Pass the snapshot URN as image_urn with prebaked=True.
+PREBAKED_BASH = r"""#!/usr/bin/env bash
+set -eux
+
+echo "[INFO] Node: $(hostname)  Arch: $(uname -m)  Kernel: $(uname -r)"
+
+# Extra packages are not in the image; install only those missing
+EXTRA_PKGS=${EXTRA_PKGS:-}
+if [ -n "$EXTRA_PKGS" ] && ! dpkg -s ${EXTRA_PKGS//,/ } >/dev/null 2>&1; then
+  APT_GET="sudo DEBIAN_FRONTEND=noninteractive apt-get -y -o Dpkg::Use-Pty=0"
+  $APT_GET update
+  $APT_GET install --no-install-recommends ${EXTRA_PKGS//,/ }
+fi
+
+if command -v nvidia-smi >/dev/null 2>&1; then
+  # The image carries the nvidia-persistenced override; COMMON_TAIL verifies it
+  sudo nvidia-ctk cdi generate --output=/etc/cdi/nvidia.yaml || true
+else
+  echo "[WARN] nvidia-smi not found. Use a GPU-enabled image or install a driver."
+fi
+""" + COMMON_TAIL
+
+# Built once and shared by every node; only the per-node env prefix differs.
+# base64 keeps the script's quotes and heredocs out of the shell/XML quoting.
+NUM_NODES = int(params.nodes)
+IMG = params.image_urn
+SETUP_B64 = base64.b64encode(
+    (PREBAKED_BASH if params.prebaked else SETUP_BASH).encode("utf-8")).decode("ascii")
+SETUP_CMD = "echo " + SETUP_B64 + " | base64 -d >/tmp/setup.sh && sudo %sbash /tmp/setup.sh"
+COMMON_ENV = "EXTRA_PKGS=%s " % ",".join(EXTRA_PKGS) if EXTRA_PKGS else ""
+if params.wheel_dataset_urn:
+    COMMON_ENV += "WHEELS_DIR=%s " % WHEELS_DIR
 
 def add_node(idx):
     node = req.RawPC("node%d" % (idx + 1))
     node.hardware_type = "nvidiagh"
-    node.disk_image = params.image_urn
+    node.disk_image = IMG
+    if params.wheel_dataset_urn:
+        bs = node.Blockstore("wheels%d" % (idx + 1), WHEELS_DIR)
+        bs.dataset = params.wheel_dataset_urn
 
     # Upload & run the setup script
-    cmd = "bash -lc 'cat >/tmp/setup.sh <<\"EOS\"\n" + SETUP_BASH + "\nEOS\nsudo bash /tmp/setup.sh'\n"
-    node.addService(PG.Execute(shell="bash", command=cmd))
-
-    # Optional: NVMe info
-    node.addService(PG.Execute(shell="bash",
-        command="bash -lc \"echo '[INFO] Local NVMe:'; lsblk -o NAME,SIZE,MODEL || true\""))
+    env = COMMON_ENV
+    if NUM_NODES > 1:
+        env += "CACHE_ROLE=%s CACHE_HOST=%s LAN_SUBNET=%s " % (
+            "server" if idx == 0 else "client", CACHE_HOST, LAN_SUBNET)
+    node.addService(PG.Execute(shell="bash", command=SETUP_CMD % env))
     return node
 
-nodes = []
-for i in range(int(params.nodes)):
-    nodes.append(add_node(i))
+nodes = [add_node(i) for i in range(NUM_NODES)]
 
 # Multi-node LAN (optional)
-if int(params.nodes) > 1:
+if NUM_NODES > 1:
     lan = PG.LAN("lan")
+    lan.vlan_tagging = True
+    if int(params.lan_bandwidth) > 0:
+        lan.bandwidth = int(params.lan_bandwidth) * 1000 * 1000  # kbps
+    if params.best_effort_lan:
+        lan.best_effort = True
     for j, n in enumerate(nodes):
         iface = n.addInterface("if%d" % (j + 1))
+        iface.addAddress(PG.IPv4Address("%s.%d" % (LAN_PREFIX, j + 1), "255.255.255.0"))
         lan.addInterface(iface)
     req.addResource(lan)
 